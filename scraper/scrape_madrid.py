@@ -1,7 +1,14 @@
 # scraper/scrape_madrid.py
+import asyncio
+import atexit
+import json
 import re
+import threading
+from html.parser import HTMLParser
 from pathlib import Path
-from playwright.sync_api import sync_playwright, TimeoutError as PWTimeoutError, Error as PWError
+from urllib.parse import parse_qsl, urlsplit
+import httpx
+from playwright.async_api import async_playwright, TimeoutError as PWTimeoutError, Error as PWError
 
 ROOT = Path(__file__).resolve().parents[1]
 PUBLIC = ROOT / "public"
@@ -10,104 +17,447 @@ PUBLIC.mkdir(parents=True, exist_ok=True)
 EXCEL_PATH = PUBLIC / "madrid_cursos.xlsx"
 URL = "https://oficinaempleo.comunidad.madrid/BuscadorCursosPublico/"
 
-def run():
-    with sync_playwright() as pw:
-        browser = pw.chromium.launch(headless=True, args=["--no-sandbox"])
-        ctx = browser.new_context(accept_downloads=True)
-        page = ctx.new_page()
-        page.goto(URL, wait_until="domcontentloaded")
+# (url, output path) pairs scraped concurrently; add regions/queries here.
+JOBS = [(URL, EXCEL_PATH)]
+MAX_CONCURRENCY = 5
+
+# Form POSTs recorded from a successful browser run, replayed over plain HTTP.
+SKILL_PATH = Path(__file__).resolve().with_name("madrid_skill.json")
+# Server-issued ASP.NET state; never recorded, always taken from the live page.
+STATE_FIELDS = {"__VIEWSTATE", "__VIEWSTATEGENERATOR", "__VIEWSTATEENCRYPTED", "__EVENTVALIDATION", "__RequestVerificationToken"}
+
+# Form controls.
+ESPECIALIDAD_LABEL_RE = re.compile(r"Especialidad.*certificado", re.I)
+# Sets the <select> named like labelRe to "0". It is "named" through
+# <label for>/wrapping labels, aria-label/aria-labelledby, or a matching <label>
+# whose next <select> it is. The first select offering "0" is only taken with anyOk.
+SELECT_ESPECIALIDAD_JS = """({labelRe, anyOk}) => {
+  const re = new RegExp(labelRe, 'i');
+  const text = el => (el && el.textContent) || '';
+  let selects;
+  try {
+    selects = [...document.querySelectorAll('select:has(option[value="0"])')];
+  } catch (e) {  // engines without :has()
+    selects = [...document.querySelectorAll('select')]
+      .filter(s => [...s.options].some(o => o.value === '0'));
+  }
+  const all = [...document.querySelectorAll('select')];
+  const following = [...document.querySelectorAll('label')].filter(l => re.test(text(l)))
+    .map(l => all.find(s => l.compareDocumentPosition(s) & Node.DOCUMENT_POSITION_FOLLOWING));
+  const named = s => [...s.labels].some(l => re.test(text(l)))
+    || re.test(s.getAttribute('aria-label') || '')
+    || (s.getAttribute('aria-labelledby') || '').split(/\s+/).some(id => re.test(text(document.getElementById(id))))
+    || following.includes(s);
+  const s = selects.find(named) || (anyOk && selects[0]);
+  if (!s) return false;
+  s.value = '0';
+  s.dispatchEvent(new Event('input', {bubbles: true}));
+  s.dispatchEvent(new Event('change', {bubbles: true}));
+  return true;
+}"""
+# Buttons are matched by role name or by one CSS union of exact-text
+# button/a/input candidates, so a miss costs a single locator query instead of
+# one per candidate. Exact text keeps e.g. a header "Buscar centro" button from
+# winning by DOM order; the loose text match is only tried once all have failed.
+BUSCAR_ROLE_RE = re.compile(r"^buscar$", re.I)
+BUSCAR_CSS = ", ".join([
+    'button:text-is("Buscar")',
+    'a:text-is("Buscar")',
+    'input[type="submit"][value="Buscar" i]',
+])
+BUSCAR_TEXT_RE = re.compile(r"^Buscar$")
+EXPORT_ROLE_RE = re.compile(r"exportar.*excel", re.I)
+EXPORT_CSS = ", ".join([
+    'button:text-is("Exportar resultados a Excel")',
+    'button:text-is("Exportar a Excel")',
+    'a:text-is("Exportar resultados a Excel")',
+    'a:text-is("Exportar a Excel")',
+])
+EXPORT_TEXT_RE = re.compile(r"Exportar\s+resultados\s+a\s+Excel", re.I)
+
+# Nothing the form flow needs; skipping these shortens page load.
+BLOCKED_RESOURCES = {"image", "font", "stylesheet", "media"}
+
+async def _block_heavy(route):
+    if route.request.resource_type in BLOCKED_RESOURCES:
+        await route.abort()
+    else:
+        await route.continue_()
+
+def is_excel(content_type, url):
+    ct = (content_type or "").lower()
+    url = url.lower()
+    return ("excel" in ct) or ("spreadsheet" in ct) or url.endswith(".xlsx") or url.endswith(".xls")
+
+# Recording side: what the page's untouched form would submit, read in-page
+# instead of serializing the DOM. Values are lists, as a name may repeat.
+FORM_DEFAULTS_JS = """() => {
+  const out = {};
+  const add = (name, value) => (out[name] = out[name] || []).push(value);
+  for (const form of document.forms) for (const el of form.elements) {
+    if (!el.name || el.disabled) continue;
+    const kind = (el.type || '').toLowerCase();
+    if (el.tagName === 'SELECT') {
+      const chosen = [...el.options].filter(o => o.defaultSelected);
+      if (!el.multiple) {
+        const first = [...el.options].find(o => !o.disabled);
+        (chosen.length ? [chosen[chosen.length - 1]] : first ? [first] : []).forEach(o => add(el.name, o.value));
+      } else {
+        chosen.forEach(o => add(el.name, o.value));
+      }
+    } else if (kind === 'checkbox' || kind === 'radio') {
+      if (el.defaultChecked) add(el.name, el.value);
+    } else if (el.tagName === 'TEXTAREA' || (el.tagName === 'INPUT' && !['submit', 'button', 'image', 'reset', 'file'].includes(kind))) {
+      add(el.name, el.defaultValue);
+    }
+  }
+  return out;
+}"""
+
+class _FormFields(HTMLParser):
+    """Replay side: the same defaults as FORM_DEFAULTS_JS, plus every control name on the page."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.fields = {}
+        self.names = set()
+        self._select = None    # [name, multiple, disabled, [(value, selected, disabled), ...]]
+        self._option = None    # [value or None, selected, disabled, text parts]
+        self._textarea = None  # [name, disabled, text parts]
+
+    def _add(self, name, value):
+        self.fields.setdefault(name, []).append(value)
+
+    def handle_starttag(self, tag, attrs):
+        a = dict(attrs)
+        name = a.get("name")
+        disabled = "disabled" in a
+        if tag == "option" and self._select is not None:
+            self._end_option()  # </option> is optional
+            self._option = [a.get("value"), "selected" in a, disabled, []]
+        elif tag == "input" and name:
+            kind = (a.get("type") or "text").lower()
+            self.names.update((name + ".x", name + ".y") if kind == "image" else (name,))
+            if disabled or kind in ("submit", "button", "image", "reset", "file"):
+                return
+            value = a.get("value")
+            if kind in ("checkbox", "radio"):
+                if "checked" in a:
+                    self._add(name, "on" if value is None else value)
+                return
+            self._add(name, value or "")
+        elif tag == "button" and name:
+            self.names.add(name)
+        elif tag == "select" and name:
+            self.names.add(name)
+            self._select = [name, "multiple" in a, disabled, []]
+        elif tag == "textarea" and name:
+            self.names.add(name)
+            self._textarea = [name, disabled, []]
+
+    def handle_data(self, data):
+        if self._option is not None:
+            self._option[3].append(data)
+        elif self._textarea is not None:
+            self._textarea[2].append(data)
+
+    def _end_option(self):
+        if self._option is not None:
+            value, selected, disabled, text = self._option
+            if value is None:  # browsers submit the option's text
+                value = " ".join("".join(text).split())
+            self._select[3].append((value, selected, disabled))
+            self._option = None
+
+    def handle_endtag(self, tag):
+        if tag == "option":
+            self._end_option()
+        elif tag == "select" and self._select is not None:
+            self._end_option()
+            name, multiple, disabled, options = self._select
+            self._select = None
+            if disabled:
+                return
+            chosen = [v for v, selected, _ in options if selected]
+            if not multiple:
+                first = [v for v, _, off in options if not off][:1]
+                chosen = chosen[-1:] or first
+            for value in chosen:
+                self._add(name, value)
+        elif tag == "textarea" and self._textarea is not None:
+            name, disabled, text = self._textarea
+            self._textarea = None
+            if not disabled:
+                self._add(name, "".join(text).removeprefix("\n"))
+
+def form_fields(html):
+    parser = _FormFields()
+    parser.feed(html)
+    return parser
+
+def _read_json(path):
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+
+def _update_json(path, key, value):
+    data = _read_json(path)
+    if value is None:
+        if data.pop(key, None) is None:
+            return
+    else:
+        data[key] = value
+    path.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+
+def _button(page, role_re, css):
+    return page.get_by_role("button", name=role_re).or_(page.locator(css)).first
+
+async def _click(page, role_re, css, text_re, timeout):
+    try:
+        await _button(page, role_re, css).click(timeout=timeout)
+    except PWError:
+        await page.get_by_text(text_re).first.click(timeout=timeout)
+
+def load_skill(url):
+    return _read_json(SKILL_PATH).get(url)
+
+def save_skill(url, posts, export_req):
+    """Record the form posts up to the Excel export; drop the skill if they can't be replayed.
+
+    Only fields that differ from the page's untouched form (the Especialidad "0",
+    the clicked control's __EVENTTARGET, ...) are kept, so server defaults such
+    as dates and hidden inputs are re-read fresh on every replay.
+    """
+    host = urlsplit(url).netloc
+    steps = []
+    for req, defaults in posts:
+        if urlsplit(req.url).netloc != host:
+            continue
+        if not (req.headers.get("content-type") or "").startswith("application/x-www-form-urlencoded"):
+            steps = None; break  # JSON/multipart bodies can't be replayed as a plain form post
+        posted = {}
+        for k, v in parse_qsl(req.post_data or "", keep_blank_values=True):
+            posted.setdefault(k, []).append(v)
+        data = {k: v for k, v in posted.items() if k not in STATE_FIELDS and defaults.get(k) != v}
+        steps.append({"url": req.url, "data": data})
+        if req == export_req:
+            break
+    else:
+        steps = None  # the export wasn't one of these posts (e.g. a GET link)
+    _update_json(SKILL_PATH, url, {"steps": steps} if steps else None)
+
+# Set by __doPostBack at click time rather than rendered as controls of their own.
+POSTBACK_FIELDS = {"__EVENTTARGET", "__EVENTARGUMENT"}
+
+def _controls_present(step, names):
+    # A renamed or removed control makes the server ignore the recorded value and
+    # export unfiltered results, which would still look like a valid Excel.
+    return all(k in names or k in POSTBACK_FIELDS for k in step["data"])
+
+async def scrape_http(url, out_path, skill):
+    """Replay the recorded form posts without a browser; False means the form drifted."""
+    part = out_path.with_name(out_path.name + ".part")
+    try:
+        async with httpx.AsyncClient(http2=True, follow_redirects=True, timeout=30) as s:
+            r = await s.get(url); r.raise_for_status()
+            page = form_fields(r.text)
+            fields, names = page.fields, page.names
+            *form_steps, export = skill["steps"]
+            for step in form_steps:
+                if not _controls_present(step, names):
+                    return False
+                r = await s.post(step["url"], data={**fields, **step["data"]}); r.raise_for_status()
+                # Partial/JSON responses keep the state from the last full page.
+                if "html" in (r.headers.get("content-type") or ""):
+                    page = form_fields(r.text)
+                    fields.update(page.fields); names |= page.names
+            if not _controls_present(export, names):
+                return False
+            async with s.stream("POST", export["url"], data={**fields, **export["data"]}) as r:
+                r.raise_for_status()
+                if not is_excel(r.headers.get("content-type"), str(r.url)):
+                    return False
+                # Stream the export to disk instead of holding it in memory.
+                with part.open("wb") as f:
+                    async for chunk in r.aiter_bytes():
+                        f.write(chunk)
+        if part.stat().st_size < 1000:
+            return False
+        part.replace(out_path)
+    except (httpx.HTTPError, ImportError):  # ImportError: http2=True without h2 installed
+        return False
+    finally:
+        part.unlink(missing_ok=True)
+    print(f"OK (http) → {out_path} ({out_path.stat().st_size} bytes)")
+    return True
+
+async def scrape_one(ctx, url, out_path):
+    page = await ctx.new_page()
+    await page.route("**/*", _block_heavy)
+    # Each POST is kept with the form defaults of the page it was sent from, so
+    # save_skill can tell user-chosen fields apart from them.
+    posts, form = [], {"defaults": {}}
+    page.on("request", lambda req: posts.append((req, form["defaults"])) if req.method == "POST" else None)
+    try:
+        await page.goto(url, wait_until="domcontentloaded")
+        form["defaults"] = await page.evaluate(FORM_DEFAULTS_JS)
 
         # --- Select “Sí” for “Especialidad de certificado” (value="0") ---
-        selected = False
+        # One in-page scan instead of a locator round-trip per <select>. Wait for
+        # the named select first, so another select that already offers "0"
+        # can't win while its options are still loading.
         try:
-            sel = page.get_by_label(re.compile(r"Especialidad.*certificado", re.I))
-            page.wait_for_selector(sel.selector + ' >> option[value="0"]', timeout=10000)
-            sel.select_option("0"); selected = True
-        except Exception:
-            pass
-        if not selected:
-            try:
-                xpath = 'xpath=//label[contains(normalize-space(.),"Especialidad") and contains(.,"certificado")]/following::select[1]'
-                page.wait_for_selector(xpath, timeout=10000)
-                page.select_option(xpath, "0"); selected = True
-            except Exception:
-                pass
-        if not selected:
-            try:
-                count = page.locator("select").count()
-                for i in range(min(count, 15)):
-                    sel_loc = page.locator("select").nth(i)
-                    if sel_loc.locator('option[value="0"]').count() > 0:
-                        page.select_option(sel_loc, "0"); selected = True; break
-            except Exception:
-                pass
-        if not selected:
-            raise RuntimeError("No pude seleccionar 'Sí' (value='0') en 'Especialidad de certificado'.")
+            await page.wait_for_function(SELECT_ESPECIALIDAD_JS, arg={"labelRe": ESPECIALIDAD_LABEL_RE.pattern, "anyOk": False}, timeout=10000)
+        except PWTimeoutError:
+            if not await page.evaluate(SELECT_ESPECIALIDAD_JS, {"labelRe": ESPECIALIDAD_LABEL_RE.pattern, "anyOk": True}):
+                raise RuntimeError("No pude seleccionar 'Sí' (value='0') en 'Especialidad de certificado'.")
 
         # --- Click “Buscar” ---
-        buscar_clicked = False
-        for s in [
-            'role=button[name=/^buscar$/i]',
-            'button:has-text("Buscar")',
-            'input[type="submit"][value*="Buscar"]',
-            'text=/^Buscar$/',
-        ]:
-            try:
-                page.locator(s).first.click(timeout=6000); buscar_clicked = True; break
-            except Exception:
-                pass
-        if not buscar_clicked:
+        form["defaults"] = await page.evaluate(FORM_DEFAULTS_JS)
+        try:
+            await _click(page, BUSCAR_ROLE_RE, BUSCAR_CSS, BUSCAR_TEXT_RE, timeout=6000)
+        except Exception:
             raise RuntimeError("No pude pulsar el botón Buscar.")
 
-        # Wait for results
+        # Wait for the first result row; if none shows up, the export click
+        # below auto-waits for its control instead of sleeping blindly here.
         try:
-            page.wait_for_selector("table, .tabla, .grid, .resultados", timeout=15000)
+            await page.wait_for_selector("table tbody tr, .tabla, .grid, .resultados", timeout=15000)
         except PWTimeoutError:
-            page.wait_for_timeout(1500)
+            pass
 
         # --- Exportar resultados a Excel ---
-        def click_export():
-            for s in [
-                'role=button[name=/exportar.*excel/i]',
-                'button:has-text("Exportar resultados a Excel")',
-                'button:has-text("Exportar a Excel")',
-                'a:has-text("Exportar resultados a Excel")',
-                'a:has-text("Exportar a Excel")',
-                'text=/Exportar\\s+resultados\\s+a\\s+Excel/i',
-            ]:
-                try:
-                    page.locator(s).first.click(timeout=4000); return True
-                except Exception:
-                    pass
-            return False
+        async def click_export():
+            try:
+                await _click(page, EXPORT_ROLE_RE, EXPORT_CSS, EXPORT_TEXT_RE, timeout=6000); return True
+            except Exception:
+                return False
+
+        # Click exactly once; listen for an Excel response from the same click in
+        # case the export is served inline instead of as a download.
+        def looks_like_excel(resp):
+            return is_excel(resp.headers.get("content-type"), resp.url)
+        excel_resp = asyncio.ensure_future(page.wait_for_event("response", predicate=looks_like_excel, timeout=30000))
+        excel_resp.add_done_callback(lambda f: f.cancelled() or f.exception())  # never leave it unretrieved
+        form["defaults"] = await page.evaluate(FORM_DEFAULTS_JS)
+        # Write to a .part file and only replace the previous export once it passes the checks.
+        part = out_path.with_name(out_path.name + ".part")
+        try:
+            # Try download event first
+            try:
+                async with page.expect_download(timeout=15000) as dl:
+                    if not await click_export():
+                        raise RuntimeError("No encontré el control de 'Exportar resultados a Excel'.")
+                d = await dl.value
+                await d.save_as(part)
+                export_req = next((r for r, _ in reversed(posts) if r.url == d.url), None)
+            except (PWTimeoutError, PWError):
+                # Fallback: response that looks like an Excel file
+                resp = await excel_resp
+                export_req = resp.request
+                if not part.write_bytes(await resp.body()):
+                    raise RuntimeError("Respuesta de export vacía.")
+
+            if not part.exists() or part.stat().st_size < 1000:
+                raise RuntimeError("Excel no descargado o es demasiado pequeño.")
+            part.replace(out_path)
+        finally:
+            excel_resp.cancel()
+            part.unlink(missing_ok=True)
+
+        print(f"OK → {out_path} ({out_path.stat().st_size} bytes)")
+        save_skill(url, posts, export_req)
+    finally:
+        await page.close()
+
+class BrowserPool:
+    """Launches Chromium lazily, once per process, and hands out fresh contexts."""
 
-        if not click_export():
-            raise RuntimeError("No encontré el control de 'Exportar resultados a Excel'.")
+    def __init__(self):
+        self._pw = None
+        self._browser = None
+        self._lock = asyncio.Lock()
 
-        # Try download event first
+    async def acquire(self):
+        async with self._lock:
+            if self._browser is None or not self._browser.is_connected():
+                await self._launch()
+        return await self._browser.new_context(accept_downloads=True)
+
+    async def release(self, ctx):
+        await ctx.close()
+
+    async def _launch(self):
+        # After a crash or disconnect, restart the driver too; it may be gone
+        # with the browser and can fail to close cleanly.
+        try:
+            await self.shutdown()
+        except Exception:
+            pass
+        self._pw = await async_playwright().start()
+        self._browser = await self._pw.chromium.launch(headless=True, args=["--no-sandbox"])
+
+    async def shutdown(self):
+        browser, self._browser = self._browser, None
+        pw, self._pw = self._pw, None
         try:
-            with page.expect_download(timeout=15000) as dl:
-                click_export()
-            d = dl.value
-            d.save_as(EXCEL_PATH)
-        except (PWTimeoutError, PWError):
-            # Fallback: response that looks like an Excel file
-            def looks_like_excel(resp):
-                ct = (resp.headers.get("content-type") or "").lower()
-                url = resp.url.lower()
-                return ("excel" in ct) or ("spreadsheet" in ct) or url.endswith(".xlsx") or url.endswith(".xls")
-            resp = page.wait_for_response(looks_like_excel, timeout=15000)
-            body = resp.body()
-            if not body:
-                raise RuntimeError("Respuesta de export vacía.")
-            EXCEL_PATH.write_bytes(body)
-
-        if not EXCEL_PATH.exists() or EXCEL_PATH.stat().st_size < 1000:
-            raise RuntimeError("Excel no descargado o es demasiado pequeño.")
-
-        print(f"OK → {EXCEL_PATH} ({EXCEL_PATH.stat().st_size} bytes)")
-
-        ctx.close(); browser.close()
+            if browser is not None and browser.is_connected():
+                await browser.close()
+        finally:
+            if pw is not None:
+                await pw.stop()
+
+POOL = BrowserPool()
+# Playwright objects are bound to the loop that created them, so the pooled
+# browser lives on one loop in a background thread. run() and run_async()
+# both hand their jobs to that loop, whatever thread or loop they come from.
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
+
+def _pool_loop():
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name="browser-pool", daemon=True).start()
+            atexit.register(_shutdown)
+    return _LOOP
+
+def _shutdown():
+    asyncio.run_coroutine_threadsafe(POOL.shutdown(), _LOOP).result(timeout=30)
+    _LOOP.call_soon_threadsafe(_LOOP.stop)
+
+async def _run_jobs(jobs):
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+
+    async def bounded(url, out_path):
+        async with sem:
+            skill = load_skill(url)
+            if skill and await scrape_http(url, out_path, skill):
+                return
+            ctx = await POOL.acquire()
+            try:
+                await scrape_one(ctx, url, out_path)
+            finally:
+                await POOL.release(ctx)
+
+    tasks = [asyncio.ensure_future(bounded(u, p)) for u, p in jobs]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # One job failed (or we were cancelled): stop the rest before re-raising.
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+
+async def run_async(jobs=JOBS):
+    """Entry point for async callers; awaits the jobs without touching the caller's loop."""
+    await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(_run_jobs(jobs), _pool_loop()))
+
+def run(jobs=JOBS):
+    asyncio.run_coroutine_threadsafe(_run_jobs(jobs), _pool_loop()).result()
 
 if __name__ == "__main__":
     run()